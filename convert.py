@@ -1,188 +1,818 @@
 #!/usr/bin/env python3
 
+import argparse
+import atexit
+import ctypes
+import ctypes.util
+import fnmatch
+import hashlib
+import html
+import importlib
+import logging
+import logging.handlers
+import multiprocessing
 import os
+import queue
+import re
+import shutil
 import subprocess
 import sys
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import repeat
+import pygments
 from pygments import highlight
-from pygments.lexers import get_lexer_for_filename, guess_lexer
+from pygments.lexers import get_all_lexers, get_lexer_for_filename, guess_lexer
+from pygments.lexers._mapping import LEXERS
+from pygments.plugin import find_plugin_lexers
 from pygments.formatters import HtmlFormatter
 from pygments.util import ClassNotFound
 
-def convert_code_to_pdf(code_file_path, output_dir):
+try:
+    from blake3 import blake3 as _cache_hash
+except ImportError:
+    _cache_hash = hashlib.sha256
+
+logger = logging.getLogger("code2pdf")
+
+def _is_extension_pattern(pattern):
+    # A plain '*.ext' glob, matched by everything sharing the final extension.
+    return pattern.startswith('*.') and not any(char in pattern[2:] for char in '*?[.')
+
+
+@lru_cache(maxsize=None)
+def _name_specific_patterns():
+    # Patterns such as 'CMakeLists.txt', 'Makefile.*' or '*.html.j2' select a
+    # lexer from more than the extension, so names matching them must not share
+    # an extension key.
+    patterns = [
+        pattern
+        for _, _, filename_patterns, _ in get_all_lexers()
+        for pattern in filename_patterns
+        if not _is_extension_pattern(pattern)
+    ]
+    return re.compile('|'.join(fnmatch.translate(pattern) for pattern in patterns))
+
+
+@lru_cache(maxsize=None)
+def _extension_lexer_table():
+    # Built once from Pygments' static lexer mapping: extensions claimed by a
+    # single lexer map straight to its (module, class name), which lets those
+    # files skip get_lexer_for_filename() and the import of unrelated lexers.
+    owners = {}
+    for class_name, (module_name, _, _, filename_patterns, _) in LEXERS.items():
+        for pattern in filename_patterns:
+            owners.setdefault(pattern, set()).add((module_name, class_name))
+    for plugin_class in find_plugin_lexers():
+        for pattern in plugin_class.filenames:
+            owners.setdefault(pattern, set()).add((plugin_class.__module__, plugin_class.__name__))
+    return {
+        pattern[1:]: next(iter(claimants))
+        for pattern, claimants in owners.items()
+        if _is_extension_pattern(pattern) and len(claimants) == 1
+    }
+
+
+@lru_cache(maxsize=256)
+def _lexer_class_for_name(lookup_name):
+    # get_lexer_for_filename() walks every registered filename pattern, so the
+    # resolved class is cached and only a fresh instance is built per file.
+    try:
+        return type(get_lexer_for_filename(lookup_name))
+    except ClassNotFound:
+        return None
+
+
+@lru_cache(maxsize=256)
+def _lexer_class_for_ext(ext):
+    known = _extension_lexer_table().get(ext)
+    if known is not None:
+        module_name, class_name = known
+        return getattr(importlib.import_module(module_name), class_name)
+    # Shared or unknown extensions need Pygments' priority rules.
+    return _lexer_class_for_name(f"x{ext}")
+
+
+def lexer_class_for_filename(file_path):
+    original_filename = os.path.basename(file_path)
+    ext = os.path.splitext(original_filename)[1]
+    if ext and not _name_specific_patterns().match(original_filename):
+        return _lexer_class_for_ext(ext)
+    return _lexer_class_for_name(original_filename)
+
+
+def lexer_for_filename(file_path, **options):
+    lexer_class = lexer_class_for_filename(file_path)
+    if lexer_class is None:
+        raise ClassNotFound(f"no lexer for filename {os.path.basename(file_path)!r} found")
+    return lexer_class(**options)
+
+
+def warm_lexer_caches(file_paths):
+    # Resolve every lexer a worker process will need while it starts up, so the
+    # lexer module imports, the plugin entry-point scan and the lookup tables
+    # are built once per worker before its first file rather than in the
+    # middle of a conversion. Run from the pool initializer because forked,
+    # forkserver and spawned workers alike start from there; a warm-up in the
+    # parent would only reach workers created with fork.
+    for file_path in file_paths:
+        lexer_class_for_filename(file_path)
+
+
+# Files per wkhtmltopdf run in --batch mode. Every run pays the Qt/WebKit
+# start-up once, and the cap keeps the command line well below OS limits.
+BATCH_SIZE = 100
+BATCH_OUTPUT_NAME = 'code2pdf'
+
+FORMATTER_OPTIONS = {
+    'style': 'default',
+    'full': False,
+    'linenos': 'inline',
+    'cssclass': 'codehilite'
+}
+
+# A file whose first BINARY_SNIFF_SIZE bytes contain a NUL, or more than
+# BINARY_CONTROL_RATIO control characters, is skipped as binary.
+BINARY_SNIFF_SIZE = 4096
+BINARY_CONTROL_RATIO = 0.3
+_CONTROL_BYTES = bytes(set(range(32)) - set(b'\t\n\r\f\b') | {127})
+
+# Files up to this size are read ahead in full by prefetch_files().
+PREFETCH_MAX_SIZE = 1024 * 1024
+
+# Bump when the generated PDFs change in a way the cache key cannot see.
+CACHE_FORMAT_VERSION = 1
+
+_thread_state = threading.local()
+
+# (library, single-thread executor) while libwkhtmltox is in use, see
+# start_libwkhtmltox(); None means wkhtmltopdf runs as a subprocess.
+_wkhtmltox = None
+
+
+# The page wrapper is assembled here rather than with full=True, which would
+# regenerate the whole style sheet on every format() call.
+PAGE_START = (
+    '<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 4.01//EN"\n'
+    '   "http://www.w3.org/TR/html4/strict.dtd">\n'
+    '<html>\n'
+    '<head>\n'
+    '  <title>'
+)
+PAGE_END = '</body>\n</html>\n'
+
+
+@lru_cache(maxsize=None)
+def _page_head_tail():
+    styledefs = HtmlFormatter(**FORMATTER_OPTIONS).get_style_defs('body')
+    return (
+        '</title>\n'
+        '  <meta http-equiv="content-type" content="text/html; charset=utf-8">\n'
+        '  <style type="text/css">\n'
+        f'{styledefs}\n'
+        '  </style>\n'
+        '</head>\n'
+        '<body>\n'
+        '<h2>'
+    )
+
+
+def wrap_page(title, body):
+    escaped_title = html.escape(title)
+    return ''.join((PAGE_START, escaped_title, _page_head_tail(), escaped_title, '</h2>\n\n', body, PAGE_END))
+
+
+def formatter_options(linenos=True):
+    return {**FORMATTER_OPTIONS, 'linenos': FORMATTER_OPTIONS['linenos'] if linenos else False}
+
+
+def get_formatter(linenos=True):
+    # Building an HtmlFormatter compiles the style, so each worker thread
+    # keeps one per line-number setting and reuses it for every file.
+    formatters = getattr(_thread_state, 'formatters', None)
+    if formatters is None:
+        formatters = _thread_state.formatters = {}
+    formatter = formatters.get(linenos)
+    if formatter is None:
+        formatter = formatters[linenos] = HtmlFormatter(**formatter_options(linenos))
+    return formatter
+
+
+def write_temp_html(html_bytes):
+    # wkhtmltopdf reads its input from a file instead of a stdin pipe; on Linux
+    # the file lives on the /dev/shm tmpfs so it never touches the disk.
+    temp_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    fd, html_path = tempfile.mkstemp(suffix='.html', dir=temp_dir)
+    try:
+        view = memoryview(html_bytes)
+        while view:
+            view = view[os.write(fd, view):]
+    except BaseException:
+        os.close(fd)
+        os.unlink(html_path)
+        raise
+    os.close(fd)
+    return html_path
+
+
+def looks_binary(head):
+    # Cheap check so binary files never reach guess_lexer(), which probes
+    # every lexer it knows about.
+    if not head:
+        return False
+    if b'\0' in head:
+        return True
+    control_bytes = len(head) - len(head.translate(None, _CONTROL_BYTES))
+    return control_bytes / len(head) > BINARY_CONTROL_RATIO
+
+
+def load_code_file(code_file_path):
+    original_filename = os.path.basename(code_file_path)
+
+    logger.info(f"     Reading code from '{code_file_path}'...")
+    try:
+        # Read raw bytes and decode once; the lexers normalise line endings.
+        # Sniff the head first so binaries are skipped without reading them whole.
+        with open(code_file_path, 'rb') as f:
+            head = f.read(BINARY_SNIFF_SIZE)
+            if looks_binary(head):
+                logger.info(f"     Skipping '{original_filename}': Looks like a binary file.")
+                return None
+            # Read the rest straight into one buffer that already holds the head,
+            # plus whatever was appended after the size was taken.
+            raw_content = bytearray(max(os.fstat(f.fileno()).st_size, len(head)))
+            raw_content[:len(head)] = head
+            with memoryview(raw_content)[len(head):] as rest:
+                size = len(head) + f.readinto(rest)
+            del raw_content[size:]
+            raw_content += f.read()
+        code_content = raw_content.decode('utf-8')
+        logger.info(f"     Read {len(code_content)} characters from '{original_filename}'.")
+    except UnicodeDecodeError:
+        logger.info(f"     Skipping '{original_filename}': Not a text file (UnicodeDecodeError).")
+        return None
+    except Exception as e:
+        logger.info(f"     Skipping '{original_filename}': Error reading file: {e}")
+        return None
+
+    if not code_content.strip():
+        logger.info(f"     Skipping '{original_filename}': File is empty or contains only whitespace.")
+        return None
+
+    logger.info(f"     Determining syntax highlighter for '{original_filename}'...")
+    try:
+        lexer = lexer_for_filename(code_file_path, stripall=True)
+        logger.info(f"     Found lexer by filename for '{original_filename}': {lexer.name}")
+    except ClassNotFound:
+        logger.info(f"     Lexer not found by filename for '{original_filename}', trying to guess from content...")
+        try:
+            lexer = guess_lexer(code_content, stripall=True)
+            logger.info(f"     Guessed lexer from content for '{original_filename}': {lexer.name}")
+        except ClassNotFound:
+            logger.info(f"     Could not determine a lexer for '{original_filename}'. Skipping.")
+            return None
+
+    return code_content, lexer
+
+
+def highlight_code(code_content, lexer, original_filename, linenos=True):
+    logger.info(f"     Generating HTML for '{original_filename}' with lexer '{lexer.name}'...")
+    highlighted_code = highlight(code_content, lexer, get_formatter(linenos))
+    # Encoded straight away so only one copy of the page is held in memory.
+    html_bytes = wrap_page(original_filename, highlighted_code).encode('utf-8')
+    del highlighted_code
+    logger.info(f"     HTML generated for '{original_filename}' (length: {len(html_bytes)} bytes).")
+    return html_bytes
+
+
+def highlight_code_file(code_file_path, linenos=True):
+    loaded = load_code_file(code_file_path)
+    if loaded is None:
+        return None
+    code_content, lexer = loaded
+    return highlight_code(code_content, lexer, os.path.basename(code_file_path), linenos)
+
+
+def default_cache_dir():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(cache_home, 'code2pdf')
+
+
+def pdf_cache_key(code_content, lexer, title, linenos=True):
+    # The title is part of the key because the formatter embeds it in the page.
+    digest = _cache_hash()
+    for part in (
+        str(CACHE_FORMAT_VERSION),
+        pygments.__version__,
+        f"{type(lexer).__module__}.{type(lexer).__qualname__}",
+        repr(sorted(formatter_options(linenos).items())),
+        title
+    ):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    digest.update(code_content.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def store_cached_pdf(rendered_pdf_path, cached_pdf_path):
+    # Copy under a temporary name first so concurrent runs never see a partial file.
+    os.makedirs(os.path.dirname(cached_pdf_path), exist_ok=True)
+    temp_path = f"{cached_pdf_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        shutil.copyfile(rendered_pdf_path, temp_path)
+        os.replace(temp_path, cached_pdf_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+
+
+def load_libwkhtmltox():
+    candidates = [ctypes.util.find_library('wkhtmltox'), 'libwkhtmltox.so', 'libwkhtmltox.dylib', 'wkhtmltox.dll']
+    for name in filter(None, candidates):
+        try:
+            lib = ctypes.CDLL(name)
+            lib.wkhtmltopdf_init.argtypes = [ctypes.c_int]
+            lib.wkhtmltopdf_init.restype = ctypes.c_int
+            lib.wkhtmltopdf_deinit.argtypes = []
+            lib.wkhtmltopdf_deinit.restype = ctypes.c_int
+            lib.wkhtmltopdf_create_global_settings.argtypes = []
+            lib.wkhtmltopdf_create_global_settings.restype = ctypes.c_void_p
+            lib.wkhtmltopdf_set_global_setting.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p]
+            lib.wkhtmltopdf_set_global_setting.restype = ctypes.c_int
+            lib.wkhtmltopdf_create_object_settings.argtypes = []
+            lib.wkhtmltopdf_create_object_settings.restype = ctypes.c_void_p
+            lib.wkhtmltopdf_set_object_setting.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p]
+            lib.wkhtmltopdf_set_object_setting.restype = ctypes.c_int
+            lib.wkhtmltopdf_create_converter.argtypes = [ctypes.c_void_p]
+            lib.wkhtmltopdf_create_converter.restype = ctypes.c_void_p
+            lib.wkhtmltopdf_add_object.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_char_p]
+            lib.wkhtmltopdf_add_object.restype = None
+            lib.wkhtmltopdf_convert.argtypes = [ctypes.c_void_p]
+            lib.wkhtmltopdf_convert.restype = ctypes.c_int
+            lib.wkhtmltopdf_destroy_converter.argtypes = [ctypes.c_void_p]
+            lib.wkhtmltopdf_destroy_converter.restype = None
+        except (OSError, AttributeError):
+            continue
+        return lib
+    return None
+
+
+def start_libwkhtmltox():
+    # libwkhtmltox drives Qt, which must be initialised and used from a single
+    # thread, so every call is funnelled through one dedicated worker.
+    global _wkhtmltox
+    lib = load_libwkhtmltox()
+    if lib is None:
+        return False
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='wkhtmltox')
+    if not executor.submit(lib.wkhtmltopdf_init, 0).result():
+        executor.shutdown()
+        return False
+    _wkhtmltox = (lib, executor)
+    return True
+
+
+def stop_libwkhtmltox():
+    global _wkhtmltox
+    if _wkhtmltox is None:
+        return
+    lib, executor = _wkhtmltox
+    _wkhtmltox = None
+    executor.submit(lib.wkhtmltopdf_deinit).result()
+    executor.shutdown()
+
+
+def _convert_with_libwkhtmltox(lib, html_paths, output_pdf_path):
+    # The converter takes ownership of the settings objects and frees them.
+    global_settings = lib.wkhtmltopdf_create_global_settings()
+    lib.wkhtmltopdf_set_global_setting(global_settings, b'out', output_pdf_path.encode('utf-8'))
+    converter = lib.wkhtmltopdf_create_converter(global_settings)
+    try:
+        for html_path in html_paths:
+            object_settings = lib.wkhtmltopdf_create_object_settings()
+            lib.wkhtmltopdf_set_object_setting(object_settings, b'page', html_path.encode('utf-8'))
+            lib.wkhtmltopdf_set_object_setting(object_settings, b'load.blockLocalFileAccess', b'false')
+            lib.wkhtmltopdf_add_object(converter, object_settings, None)
+        return 0 if lib.wkhtmltopdf_convert(converter) else 1
+    finally:
+        lib.wkhtmltopdf_destroy_converter(converter)
+
+
+def _run_wkhtmltopdf_process(html_paths, output_pdf_path, label):
+    command = [
+        'wkhtmltopdf',
+        '--enable-local-file-access',
+        *html_paths,
+        output_pdf_path
+    ]
+    logger.info(f"     Executing command: {' '.join(command)}")
+
+    # The PDF is written straight to output_pdf_path, so only stderr (progress
+    # and errors) is worth collecting.
+    process = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=False)
+    stderr = process.stderr
+
+    if stderr:
+        # Scan the raw bytes and only decode when the output is actually logged.
+        if b"Done" in stderr or b"Exit with code 0" in stderr or not stderr.strip():
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(f"     wkhtmltopdf stderr for '{label}' (likely status messages):\n{stderr.decode('utf-8', errors='ignore')}")
+        else:
+            logger.error(f"     wkhtmltopdf ERROR output for '{label}':\n{stderr.decode('utf-8', errors='ignore')}")
+
+    return process.returncode
+
+
+def run_wkhtmltopdf(html_paths, output_pdf_path, label):
+    wkhtmltox = _wkhtmltox
+    if wkhtmltox is not None:
+        lib, executor = wkhtmltox
+        logger.info(f"     Rendering {len(html_paths)} page(s) for '{label}' with libwkhtmltox...")
+        returncode = executor.submit(_convert_with_libwkhtmltox, lib, html_paths, output_pdf_path).result()
+    else:
+        returncode = _run_wkhtmltopdf_process(html_paths, output_pdf_path, label)
+
+    logger.info(f"     wkhtmltopdf process for '{label}' finished with return code: {returncode}")
+
+    if returncode == 0:
+        if os.path.exists(output_pdf_path) and os.path.getsize(output_pdf_path) > 0:
+             logger.info(f"     SUCCESS: PDF file for '{label}' created at '{output_pdf_path}'.")
+             return True
+        elif os.path.exists(output_pdf_path):
+             logger.warning(f"     WARNING: PDF for '{label}' created at '{output_pdf_path}' but it is empty. wkhtmltopdf might have had issues with the HTML content.")
+        else:
+             logger.warning(f"     WARNING: wkhtmltopdf exited successfully (code 0) for '{label}' but output PDF not found at '{output_pdf_path}'. Check permissions or path.")
+    else:
+        logger.error(f"     ERROR: wkhtmltopdf failed for '{label}' with return code {returncode}. Check stderr above for details.")
+    return False
+
+
+def create_temp_pdf(output_dir):
+    # Like tempfile.mkstemp(), but created with the umask-governed mode a plain
+    # open() would use: the file is renamed onto the final PDF, so mkstemp()'s
+    # 0600 would leave every output readable by its owner only.
+    while True:
+        temp_pdf_path = os.path.join(output_dir, f"tmp{os.urandom(6).hex()}.pdf")
+        try:
+            fd = os.open(temp_pdf_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        except FileExistsError:
+            continue
+        os.close(fd)
+        return temp_pdf_path
+
+
+def convert_code_to_pdf(code_file_path, output_dir, cache_dir=None, linenos=True):
     base_filename = os.path.splitext(os.path.basename(code_file_path))[0]
     pdf_filename = f"{base_filename}.pdf"
     output_pdf_path = os.path.join(output_dir, pdf_filename)
     original_filename = os.path.basename(code_file_path)
 
-    print(f"---> Attempting to convert '{original_filename}' to '{pdf_filename}'")
+    logger.info(f"---> Attempting to convert '{original_filename}' to '{pdf_filename}'")
 
     try:
-        print(f"     Reading code from '{code_file_path}'...")
-        try:
-            with open(code_file_path, 'r', encoding='utf-8') as f:
-                code_content = f.read()
-            print(f"     Read {len(code_content)} characters.")
-        except UnicodeDecodeError:
-            print(f"     Skipping '{original_filename}': Not a text file (UnicodeDecodeError).")
-            return
-        except Exception as e:
-            print(f"     Skipping '{original_filename}': Error reading file: {e}")
-            return
-
-        if not code_content.strip():
-            print(f"     Skipping '{original_filename}': File is empty or contains only whitespace.")
+        loaded = load_code_file(code_file_path)
+        if loaded is None:
             return
+        code_content, lexer = loaded
 
-        print(f"     Determining syntax highlighter for '{original_filename}'...")
+        # Render (or copy from the cache) into a private file and move it into
+        # place afterwards: files such as 'a.py' and 'a.c' share 'a.pdf' and may
+        # be converted at once, so the shared output path is never read back.
+        temp_pdf_path = create_temp_pdf(output_dir)
         try:
-            lexer = get_lexer_for_filename(code_file_path, stripall=True)
-            print(f"     Found lexer by filename: {lexer.name}")
-        except ClassNotFound:
-            print(f"     Lexer not found by filename, trying to guess from content...")
-            try:
-                lexer = guess_lexer(code_content, stripall=True)
-                print(f"     Guessed lexer from content: {lexer.name}")
-            except ClassNotFound:
-                print(f"     Could not determine a lexer for '{original_filename}'. Skipping.")
-                return
-
-        print(f"     Generating HTML with lexer '{lexer.name}'...")
-        formatter = HtmlFormatter(
-            style='default',
-            full=True,
-            linenos='inline',
-            cssclass='codehilite',
-            title=original_filename
-        )
-        highlighted_html = highlight(code_content, lexer, formatter)
-        print(f"     HTML generated (length: {len(highlighted_html)}).")
-
-        print(f"     Calling wkhtmltopdf to create '{output_pdf_path}'...")
-        command = [
-            'wkhtmltopdf',
-            '--enable-local-file-access', 
-            '-',
-            output_pdf_path
-        ]
-        print(f"     Executing command: {' '.join(command)}")
-
-        process = subprocess.Popen(
-            command,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
-        stdout, stderr = process.communicate(input=highlighted_html.encode('utf-8'))
-
-        if stdout:
-            print(f"     wkhtmltopdf stdout:\n{stdout.decode('utf-8', errors='ignore')}")
-        if stderr:
-            decoded_stderr = stderr.decode('utf-8', errors='ignore')
-            if "Done" in decoded_stderr or "Exit with code 0" in decoded_stderr or not decoded_stderr.strip() :
-                 print(f"     wkhtmltopdf stderr (likely status messages):\n{decoded_stderr}")
-            else:
-                 print(f"     wkhtmltopdf ERROR output:\n{decoded_stderr}", file=sys.stderr)
+            cached_pdf_path = None
+            if cache_dir:
+                cache_key = pdf_cache_key(code_content, lexer, original_filename, linenos)
+                cached_pdf_path = os.path.join(cache_dir, cache_key[:2], f"{cache_key}.pdf")
+                # The entry may vanish between the check and the copy (another
+                # run pruning the cache); that is just a miss.
+                try:
+                    shutil.copyfile(cached_pdf_path, temp_pdf_path)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logger.warning(f"     WARNING: Could not read the cached PDF for '{original_filename}', rendering it instead: {e}")
+                else:
+                    os.replace(temp_pdf_path, output_pdf_path)
+                    logger.info(f"     SUCCESS: PDF file for '{original_filename}' copied from cache to '{output_pdf_path}'.")
+                    return
 
+            html_bytes = highlight_code(code_content, lexer, original_filename, linenos)
+            html_path = write_temp_html(html_bytes)
+            del html_bytes
 
-        print(f"     wkhtmltopdf process finished with return code: {process.returncode}")
+            logger.info(f"     Calling wkhtmltopdf to create '{output_pdf_path}'...")
+            try:
+                created = run_wkhtmltopdf([html_path], temp_pdf_path, original_filename)
+            finally:
+                os.unlink(html_path)
 
-        if process.returncode == 0:
-            if os.path.exists(output_pdf_path) and os.path.getsize(output_pdf_path) > 0:
-                 print(f"     SUCCESS: PDF file created at '{output_pdf_path}'.")
-            elif os.path.exists(output_pdf_path):
-                 print(f"     WARNING: PDF created at '{output_pdf_path}' but it is empty. wkhtmltopdf might have had issues with the HTML content.", file=sys.stderr)
-            else:
-                 print(f"     WARNING: wkhtmltopdf exited successfully (code 0) but output PDF not found at '{output_pdf_path}'. Check permissions or path.", file=sys.stderr)
-        else:
-            print(f"     ERROR: wkhtmltopdf failed for '{original_filename}' with return code {process.returncode}. Check stderr above for details.", file=sys.stderr)
+            if created and cached_pdf_path:
+                try:
+                    store_cached_pdf(temp_pdf_path, cached_pdf_path)
+                except OSError as e:
+                    logger.warning(f"     WARNING: Could not store '{pdf_filename}' in the cache: {e}")
+
+            if created:
+                os.replace(temp_pdf_path, output_pdf_path)
+                logger.info(f"     Moved '{os.path.basename(temp_pdf_path)}' to '{output_pdf_path}'.")
+        finally:
+            if os.path.exists(temp_pdf_path):
+                os.unlink(temp_pdf_path)
 
     except FileNotFoundError:
-        print(f"     ERROR: Could not find file '{code_file_path}'. This shouldn't happen if listed by os.listdir.", file=sys.stderr)
+        logger.error(f"     ERROR: Could not find file '{code_file_path}'. This shouldn't happen if listed by os.scandir.")
+    except Exception as e:
+        logger.exception(f"     ERROR: An unexpected error occurred processing '{original_filename}': {type(e).__name__} - {e}")
+
+
+def highlight_to_temp_html(code_file_path, linenos=True):
+    original_filename = os.path.basename(code_file_path)
+
+    logger.info(f"---> Highlighting '{original_filename}' for the combined PDF")
+
+    try:
+        html_bytes = highlight_code_file(code_file_path, linenos)
+        if html_bytes is None:
+            return None
+        return write_temp_html(html_bytes)
+    except Exception as e:
+        logger.exception(f"     ERROR: An unexpected error occurred processing '{original_filename}': {type(e).__name__} - {e}")
+        return None
+
+
+def convert_batch_to_pdf(html_paths, output_pdf_path):
+    pdf_filename = os.path.basename(output_pdf_path)
+
+    logger.info(f"---> Combining {len(html_paths)} file(s) into '{pdf_filename}'")
+
+    try:
+        run_wkhtmltopdf(html_paths, output_pdf_path, pdf_filename)
     except Exception as e:
-        print(f"     ERROR: An unexpected error occurred processing '{original_filename}': {type(e).__name__} - {e}", file=sys.stderr)
-        import traceback
-        traceback.print_exc(file=sys.stderr)
+        logger.exception(f"     ERROR: An unexpected error occurred creating '{pdf_filename}': {type(e).__name__} - {e}")
+    finally:
+        for html_path in html_paths:
+            os.unlink(html_path)
+
+
+def batch_output_names(batch_count):
+    if batch_count == 1:
+        return [f"{BATCH_OUTPUT_NAME}.pdf"]
+    return [f"{BATCH_OUTPUT_NAME}-{number:03d}.pdf" for number in range(1, batch_count + 1)]
+
+
+def prefetch_files(file_paths):
+    # Ask the kernel to start reading the input files in the background so the
+    # workers rarely block on a cold page cache. Only available on POSIX.
+    # Earlier PDFs are never converted, and large files are usually binaries
+    # that get skipped after the first BINARY_SNIFF_SIZE bytes, so only that
+    # much of them is requested.
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    for file_path in file_paths:
+        if file_path.lower().endswith('.pdf'):
+            continue
+        try:
+            fd = os.open(file_path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            size = os.fstat(fd).st_size
+            length = size if size <= PREFETCH_MAX_SIZE else BINARY_SNIFF_SIZE
+            os.posix_fadvise(fd, 0, length, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+
+def _init_worker_process(log_queue, file_paths):
+    # Worker processes hand their log records back to the parent's listener.
+    logger.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    warm_lexer_caches(file_paths)
 
 
-def main():
-    print("--- Entering main() ---")
-    sys.stdout.flush()
+@contextmanager
+def worker_pool(max_workers, processes, file_paths=()):
+    if not processes:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            yield executor
+        return
 
+    log_queue = multiprocessing.Queue()
+    log_forwarder = logging.handlers.QueueListener(log_queue, *logger.handlers)
+    log_forwarder.start()
     try:
-        current_dir = os.getcwd()
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=_init_worker_process,
+            initargs=(log_queue, file_paths)
+        ) as executor:
+            yield executor
+    finally:
+        log_forwarder.stop()
+
+
+def default_max_workers():
+    return min(32, os.cpu_count() or 4)
+
+
+def main(max_workers=None, batch=False, cache_dir=None, in_process=False, processes=False,
+         linenos=True, input_dir=None):
+    # libwkhtmltox lives in this process only; worker processes cannot use it.
+    if in_process and processes:
+        raise ValueError("in_process cannot be combined with processes")
+    logger.info("--- Entering main() ---")
+
+    try:
+        if in_process:
+            if start_libwkhtmltox():
+                logger.info("Rendering in-process with libwkhtmltox (one page at a time)")
+            else:
+                logger.warning("WARNING: libwkhtmltox could not be loaded, falling back to the wkhtmltopdf command.")
+
+        current_dir = os.path.abspath(input_dir) if input_dir else os.getcwd()
         output_dir = current_dir
         processed_files_count = 0
-        script_name = os.path.basename(__file__)
+        script_path = os.path.realpath(__file__)
+        script_name = os.path.basename(script_path)
 
-        print(f"--- Code to PDF Converter (Universal) ---")
-        print(f"Script name is: '{script_name}' (will be excluded from conversion)")
-        print(f"Scanning for code files in directory: '{current_dir}'")
+        logger.info(f"--- Code to PDF Converter (Universal) ---")
+        logger.info(f"Script name is: '{script_name}' (will be excluded from conversion)")
+        logger.info(f"Scanning for code files in directory: '{current_dir}'")
 
-        print("\nItems found in directory:")
+        logger.info("\nItems found in directory:")
         try:
-            all_items = os.listdir(current_dir)
+            # scandir() reports the entry type from the directory listing itself,
+            # so telling files from directories needs no extra stat() per entry.
+            with os.scandir(current_dir) as it:
+                all_entries = list(it)
         except OSError as e:
-            print(f"Error listing directory '{current_dir}': {e}", file=sys.stderr)
+            logger.error(f"Error listing directory '{current_dir}': {e}")
             return
 
-        if not all_items:
-            print("(Directory is empty)")
+        if not all_entries:
+            logger.info("(Directory is empty)")
         else:
-            for item_name in all_items:
-                print(f"- {item_name}")
-        print("-" * 20)
-        sys.stdout.flush()
-
-        for filename in all_items:
-            if filename == script_name:
-                print(f"\nIgnoring script: '{filename}'")
-                continue
+            for entry in all_entries:
+                logger.info(f"- {entry.name}")
+        logger.info("-" * 20)
 
-            file_path = os.path.join(current_dir, filename)
+        files = []
+        for entry in all_entries:
+            if entry.name == script_name and os.path.realpath(entry.path) == script_path:
+                logger.info(f"\nIgnoring script: '{entry.name}'")
+                continue
 
-            if os.path.isfile(file_path):
-                convert_code_to_pdf(file_path, output_dir)
-                processed_files_count +=1
+            if entry.is_file():
+                files.append(entry.path)
             else:
-                print(f"\nIgnoring directory or non-file: '{filename}'")
-            sys.stdout.flush()
+                logger.info(f"\nIgnoring directory or non-file: '{entry.name}'")
+
+        prefetch_files(files)
+
+        # Each conversion spends most of its time waiting on its own wkhtmltopdf
+        # child process and only touches local state, so threads overlap well.
+        # Worker processes also run the CPU-bound highlighting in parallel.
+        if max_workers is None:
+            max_workers = default_max_workers()
+        worker_kind = 'process(es)' if processes else 'thread(s)'
+        if batch:
+            files.sort()
+            logger.info(f"Highlighting {len(files)} file(s) using up to {max_workers} worker {worker_kind}...")
+            with worker_pool(max_workers, processes, files) as executor:
+                html_paths = [path for path in executor.map(highlight_to_temp_html, files, repeat(linenos), chunksize=4) if path is not None]
+                batches = [html_paths[i:i + BATCH_SIZE] for i in range(0, len(html_paths), BATCH_SIZE)]
+                output_paths = [os.path.join(output_dir, name) for name in batch_output_names(len(batches))]
+                list(executor.map(convert_batch_to_pdf, batches, output_paths))
+        else:
+            if cache_dir:
+                logger.info(f"Using PDF cache in '{cache_dir}'")
+            logger.info(f"Converting {len(files)} file(s) using up to {max_workers} worker {worker_kind}...")
+            with worker_pool(max_workers, processes, files) as executor:
+                list(executor.map(
+                    convert_code_to_pdf, files, repeat(output_dir), repeat(cache_dir), repeat(linenos), chunksize=4
+                ))
+        processed_files_count = len(files)
 
-        print("-" * 20)
+        logger.info("-" * 20)
         if processed_files_count == 0:
-             print("RESULT: No other files to process were found in this directory.")
+             logger.info("RESULT: No other files to process were found in this directory.")
         else:
-            print(f"RESULT: Attempted to process {processed_files_count} file(s)")
+            logger.info(f"RESULT: Attempted to process {processed_files_count} file(s)")
 
 
     except Exception as e:
-        print(f"\n!!! UNEXPECTED ERROR INSIDE main() !!!", file=sys.stderr)
-        print(f"Error Type: {type(e).__name__}", file=sys.stderr)
-        print(f"Error Details: {e}", file=sys.stderr)
-        import traceback
-        traceback.print_exc(file=sys.stderr)
+        logger.error(f"\n!!! UNEXPECTED ERROR INSIDE main() !!!")
+        logger.error(f"Error Type: {type(e).__name__}")
+        logger.exception(f"Error Details: {e}")
     finally:
-        print("--- Exiting main() ---")
-        sys.stdout.flush()
+        stop_libwkhtmltox()
+        logger.info("--- Exiting main() ---")
+
+def start_logging():
+    # Worker threads only put records on a queue; a single listener thread
+    # writes them out, so the workers never contend for stdout/stderr.
+    log_queue = queue.SimpleQueue()
+    stdout_handler = logging.StreamHandler(sys.stdout)
+    stdout_handler.addFilter(lambda record: record.levelno < logging.WARNING)
+    stderr_handler = logging.StreamHandler(sys.stderr)
+    stderr_handler.setLevel(logging.WARNING)
+    listener = logging.handlers.QueueListener(
+        log_queue, stdout_handler, stderr_handler, respect_handler_level=True
+    )
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    listener.start()
+    return listener
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Convert source code files in a directory into syntax-highlighted PDFs."
+    )
+    parser.add_argument(
+        '--input-dir',
+        default=None,
+        help="Directory containing the code files; the PDFs are written next to them (default: current directory)"
+    )
+    parser.add_argument(
+        '-j', '--jobs', '--max-workers',
+        dest='jobs',
+        type=int,
+        default=None,
+        help=f"Number of files to convert concurrently (default: {default_max_workers()})"
+    )
+    parser.add_argument(
+        '--processes',
+        action='store_true',
+        help="Use worker processes instead of threads so syntax highlighting also runs in parallel"
+    )
+    parser.add_argument(
+        '--batch',
+        action='store_true',
+        help=f"Combine all files into a single '{BATCH_OUTPUT_NAME}.pdf', running wkhtmltopdf once per {BATCH_SIZE} files"
+    )
+    parser.add_argument(
+        '--cache-dir',
+        default=default_cache_dir(),
+        help="Directory for cached PDFs, reused when a file has not changed (default: %(default)s)"
+    )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help="Always run wkhtmltopdf instead of reusing cached PDFs"
+    )
+    parser.add_argument(
+        '--no-linenos',
+        action='store_true',
+        help="Leave out line numbers, which also makes highlighting cheaper"
+    )
+    parser.add_argument(
+        '--in-process',
+        action='store_true',
+        help="Render with the libwkhtmltox library instead of starting wkhtmltopdf for every file (renders one file at a time)"
+    )
+    args = parser.parse_args(argv)
+    if args.jobs is not None and args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.in_process and args.processes:
+        parser.error("--in-process cannot be combined with --processes")
+    if args.input_dir is not None and not os.path.isdir(args.input_dir):
+        parser.error(f"--input-dir '{args.input_dir}' is not a directory")
+    return args
 
 if __name__ == "__main__":
-    print("Checking for wkhtmltopdf...")
-    sys.stdout.flush()
+    args = parse_args()
+    atexit.register(start_logging().stop)
+    logger.info("Checking for wkhtmltopdf...")
     try:
         process_check = subprocess.run(['wkhtmltopdf', '--version'], check=True, capture_output=True, text=True)
-        print(f"wkhtmltopdf found: {process_check.stdout.strip()}")
-        sys.stdout.flush()
-        main()
+        logger.info(f"wkhtmltopdf found: {process_check.stdout.strip()}")
+        main(
+            max_workers=args.jobs,
+            batch=args.batch,
+            cache_dir=None if args.no_cache else args.cache_dir,
+            in_process=args.in_process,
+            processes=args.processes,
+            linenos=not args.no_linenos,
+            input_dir=args.input_dir
+        )
     except (subprocess.CalledProcessError, FileNotFoundError) as e:
-        print(f"Error during wkhtmltopdf check: {e}", file=sys.stderr)
-        print("FATAL: 'wkhtmltopdf' command not found or failed to execute.", file=sys.stderr)
-        print("Please ensure wkhtmltopdf is installed and in your system's PATH.", file=sys.stderr)
+        logger.error(f"Error during wkhtmltopdf check: {e}")
+        logger.error("FATAL: 'wkhtmltopdf' command not found or failed to execute.")
+        logger.error("Please ensure wkhtmltopdf is installed and in your system's PATH.")
         sys.exit(1)
     except Exception as e:
-        print(f"\n!!! UNEXPECTED ERROR BEFORE main() CALL !!!", file=sys.stderr)
-        print(f"Error Type: {type(e).__name__}", file=sys.stderr)
-        print(f"Error Details: {e}", file=sys.stderr)
-        import traceback
-        traceback.print_exc(file=sys.stderr)
+        logger.error(f"\n!!! UNEXPECTED ERROR BEFORE main() CALL !!!")
+        logger.error(f"Error Type: {type(e).__name__}")
+        logger.exception(f"Error Details: {e}")
         sys.exit(1)
 
-    print("--- Script execution finished ---")
+    logger.info("--- Script execution finished ---")